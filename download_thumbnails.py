@@ -5,14 +5,15 @@ Uses the filename from the thumbnail URL (keeps original name).
 Skips already downloaded thumbnails.
 """
 
-import pandas as pd
-import requests
+import csv
 import os
 from pathlib import Path
 import time
 import argparse
+import functools
 import logging
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http_utils import DOWNLOADED, FAILED, SKIPPED, DownloadCache, TokenBucket, download_file, set_pool_size
 
 # Set up logging
 logging.basicConfig(
@@ -25,24 +26,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def download_thumbnail(url, folder="thumbnails"):
+@functools.lru_cache(maxsize=None)
+def url_to_png_name(url):
     """
-    Download a PNG thumbnail from a URL and save it with the filename from the URL.
-    
-    Args:
-        url (str): The URL of the thumbnail to download
-        folder (str): The folder to save the thumbnail in
-        
-    Returns:
-        bool: True if download was successful, False otherwise
+    Derive the thumbnail filename from its URL (last path segment, forced to .png).
+    Uses plain string splits instead of urlparse since this runs once per CSV row.
     """
-    if not url or pd.isna(url):
-        logger.warning(f"Empty URL provided")
-        return False
-    
-    # Extract filename from URL
-    parsed_url = urlparse(url)
-    filename = os.path.basename(parsed_url.path)
+    filename = url.split('?', 1)[0].split('#', 1)[0].rsplit('/', 1)[-1]
     
     # If no filename in URL, create a generic one
     if not filename or '.' not in filename:
@@ -52,33 +42,47 @@ def download_thumbnail(url, folder="thumbnails"):
     if not filename.endswith('.png'):
         filename += '.png'
     
+    return filename
+
+def download_thumbnail(url, filename, folder="thumbnails", rate_limiter=None, cache=None):
+    """
+    Download a PNG thumbnail from a URL and save it under the given filename.
+    
+    Args:
+        url (str): The URL of the thumbnail to download
+        filename (str): The filename to save it as (see url_to_png_name)
+        folder (str): The folder to save the thumbnail in
+        rate_limiter (TokenBucket): Optional limiter shared between download workers
+        cache (DownloadCache): Optional validator cache; existing files found in it are
+            revalidated with a conditional request instead of being skipped
+        
+    Returns:
+        str: DOWNLOADED, SKIPPED if the existing file was kept (already present or not modified), or FAILED
+    """
+    if not url or not url.strip():
+        logger.warning(f"Empty URL provided")
+        return FAILED
+    
     # Create folder if it doesn't exist
     Path(folder).mkdir(parents=True, exist_ok=True)
     
     filepath = os.path.join(folder, filename)
     
-    # Skip if file already exists
-    if os.path.exists(filepath):
+    # Skip if file already exists and there is nothing to revalidate it against
+    if os.path.exists(filepath) and (cache is None or cache.get(filename) is None):
         logger.info(f"File already exists, skipping: {filename}")
-        return True
+        return SKIPPED
     
     try:
-        # Download the image
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        response = requests.get(url, timeout=30, headers=headers)
-        response.raise_for_status()
-        
-        # Save the image
-        with open(filepath, 'wb') as f:
-            f.write(response.content)
-        
+        # Download the image, streaming it to disk so only one chunk is held in memory
+        if not download_file(url, filepath, cache=cache, timeout=30, rate_limiter=rate_limiter):
+            logger.info(f"Not modified, keeping: {filename}")
+            return SKIPPED
         logger.info(f"Downloaded: {filename}")
-        return True
+        return DOWNLOADED
     except Exception as e:
         logger.error(f"Failed to download {url} as {filename}: {e}")
-        return False
+        return FAILED
 
 def load_existing_thumbnails(folder="thumbnails"):
     """
@@ -98,7 +102,7 @@ def load_existing_thumbnails(folder="thumbnails"):
     logger.info(f"Found {len(existing)} existing thumbnails")
     return existing
 
-def main(csv_file, folder, skip_existing=True, delay=0.1):
+def main(csv_file, folder, skip_existing=True, rate_per_sec=10.0, workers=16):
     """
     Main function to download thumbnails from CSV.
     
@@ -106,20 +110,25 @@ def main(csv_file, folder, skip_existing=True, delay=0.1):
         csv_file (str): Path to the CSV file
         folder (str): Folder to save thumbnails
         skip_existing (bool): Whether to skip already downloaded thumbnails
-        delay (float): Delay between downloads in seconds
+        rate_per_sec (float): Average request rate across all workers (<= 0 disables limiting)
+        workers (int): Number of concurrent download workers
     """
+    # Only the thumbnail column is needed, so read it with the csv module instead of pandas
     try:
-        df = pd.read_csv(csv_file)
-        logger.info(f"Loaded {len(df)} rows from {csv_file}")
+        with open(csv_file, newline='') as fh:
+            reader = csv.DictReader(fh)
+            
+            # Check if the required columns exist
+            if not reader.fieldnames or 'property_thumbnail' not in reader.fieldnames:
+                logger.error("Column 'property_thumbnail' not found in CSV")
+                return
+            
+            thumbnail_urls = [row['property_thumbnail'] for row in reader]
+        logger.info(f"Loaded {len(thumbnail_urls)} rows from {csv_file}")
     except Exception as e:
         logger.error(f"Error reading CSV file: {e}")
         return
     
-    # Check if the required columns exist
-    if 'property_thumbnail' not in df.columns:
-        logger.error("Column 'property_thumbnail' not found in CSV")
-        return
-    
     # Load existing thumbnails
     existing_thumbnails = set()
     if skip_existing:
@@ -130,54 +139,62 @@ def main(csv_file, folder, skip_existing=True, delay=0.1):
     failed_count = 0
     skipped_count = 0
     
-    for index, row in df.iterrows():
-        thumbnail_url = row['property_thumbnail']
-        
+    # Collect the (URL, filename) pairs that still need downloading
+    pending_urls = []
+    queued_filenames = set()
+    for index, thumbnail_url in enumerate(thumbnail_urls):
         # Skip if URL is empty
-        if pd.isna(thumbnail_url) or not thumbnail_url.strip():
+        if not thumbnail_url or not thumbnail_url.strip():
             logger.warning(f"Row {index}: Empty thumbnail URL")
             failed_count += 1
             continue
         
         # Extract filename from URL to check if already exists
-        parsed_url = urlparse(thumbnail_url)
-        filename = os.path.basename(parsed_url.path)
-        if not filename or '.' not in filename:
-            filename = f"thumbnail_{int(time.time())}.png"
-        if not filename.endswith('.png'):
-            filename += '.png'
+        filename = url_to_png_name(thumbnail_url)
         
-        # Skip if already downloaded
-        if skip_existing and filename in existing_thumbnails:
+        # Skip if already downloaded (or already queued by an earlier row)
+        if (skip_existing and filename in existing_thumbnails) or filename in queued_filenames:
             skipped_count += 1
             logger.debug(f"Skipping already downloaded: {filename}")
             continue
         
-        # Download the thumbnail
-        success = download_thumbnail(thumbnail_url, folder)
-        if success:
-            downloaded_count += 1
-        else:
-            failed_count += 1
-        
-        # Add a small delay to be respectful to the server
-        if delay > 0:
-            time.sleep(delay)
+        pending_urls.append((thumbnail_url, filename))
+        queued_filenames.add(filename)
+    
+    # Download the thumbnails concurrently; the token bucket keeps the overall request rate polite
+    rate_limiter = TokenBucket(rate_per_sec)
+    set_pool_size(workers)
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    cache = DownloadCache(os.path.join(folder, "download_cache.json"))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(download_thumbnail, url, filename, folder, rate_limiter, cache)
+            for url, filename in pending_urls
+        ]
+        for future in as_completed(futures):
+            status = future.result()
+            if status == DOWNLOADED:
+                downloaded_count += 1
+            elif status == SKIPPED:
+                skipped_count += 1
+            else:
+                failed_count += 1
+    cache.save()
     
     logger.info(f"\nDownload Summary:")
     logger.info(f"Successfully downloaded: {downloaded_count}")
     logger.info(f"Failed to download: {failed_count}")
-    logger.info(f"Skipped (already existed): {skipped_count}")
+    logger.info(f"Skipped (already existed or not modified): {skipped_count}")
     logger.info(f"Total processed: {downloaded_count + failed_count + skipped_count}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Download thumbnails from CSV using filename from URL")
     parser.add_argument("--csv", default="results_gee_filtered.csv", help="CSV file path")
     parser.add_argument("--folder", default="thumbnails", help="Folder to save thumbnails")
-    parser.add_argument("--no-skip", action="store_true", help="Don't skip already downloaded thumbnails")
-    parser.add_argument("--delay", type=float, default=0.1, help="Delay between downloads in seconds")
+    parser.add_argument("--no-skip", action="store_true", help="Don't skip already downloaded thumbnails (revalidates them with conditional requests)")
+    parser.add_argument("--rate-per-sec", type=float, default=10.0, help="Average download requests per second across all workers (0 = unlimited)")
+    parser.add_argument("--workers", type=int, default=16, help="Number of concurrent download workers")
     
     args = parser.parse_args()
     
-    main(args.csv, args.folder, not args.no_skip, args.delay)
-
+    main(args.csv, args.folder, not args.no_skip, args.rate_per_sec, args.workers)
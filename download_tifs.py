@@ -5,13 +5,16 @@ Matches thumbnail base names to CSV uuid column and downloads TIF files.
 """
 
 import pandas as pd
-import requests
+import numpy as np
 import os
+import csv
 import argparse
 import logging
 from pathlib import Path
 from urllib.parse import urlparse
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http_utils import (DOWNLOADED, FAILED, SKIPPED, DownloadCache, InvalidContentError, TokenBucket,
+                        download_file, set_pool_size)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,78 +26,97 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def download_tif(url, output_path):
-    """Download TIF file from URL."""
+# Large copy chunks keep the Python-level loop and write() syscall count low for multi-GB TIFs
+TIF_CHUNK_SIZE = 1024 * 1024
+
+# Classic TIFF and BigTIFF byte-order marks plus version numbers
+TIF_MAGIC_NUMBERS = (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')
+
+def has_tif_header(path):
+    """
+    Check that a file starts with a TIFF/BigTIFF header.
+    Only the first bytes are read, so this stays cheap for multi-GB files.
+    """
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        response = requests.get(url, timeout=60, headers=headers, stream=True)
-        response.raise_for_status()
-        
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        return True
+        with open(path, 'rb') as f:
+            return f.read(4) in TIF_MAGIC_NUMBERS
+    except OSError:
+        return False
+
+def download_tif(url, output_path, rate_limiter=None, cache=None):
+    """
+    Download TIF file from URL (conditionally, if cache holds validators for an existing file).
+    Returns DOWNLOADED, SKIPPED if the server reported the existing file as not modified, or FAILED.
+    """
+    try:
+        # The header is checked on the temporary file, so a bad body never replaces an existing TIF
+        if not download_file(url, output_path, cache=cache, timeout=60, chunk_size=TIF_CHUNK_SIZE,
+                             rate_limiter=rate_limiter, validate=has_tif_header):
+            logger.info(f"Not modified, keeping: {os.path.basename(output_path)}")
+            return SKIPPED
+        return DOWNLOADED
+    except InvalidContentError:
+        # e.g. an HTML error page served with a 200 status
+        logger.error(f"Downloaded file from {url} is not a TIF, discarding it")
+        return FAILED
     except Exception as e:
         logger.error(f"Failed to download {url}: {e}")
-        return False
+        return FAILED
 
-def extract_author(row):
+def _stripped_or_na(df, column):
+    """Return a column as stripped strings with missing or blank values as NA."""
+    if column not in df.columns:
+        return pd.Series(pd.NA, index=df.index, dtype='string')
+    values = df[column].astype('string').str.strip()
+    return values.mask(values.eq(''))
+
+def _parse_dates(df, column):
+    """Parse a date column in one vectorized pass (unparseable or missing values become NaT)."""
+    if column not in df.columns:
+        return pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns, UTC]')
+    return pd.to_datetime(df[column], errors='coerce', utc=True, format='mixed')
+
+def extract_authors(df):
     """
-    Extract author name from CSV row.
+    Extract author names for all CSV rows.
     Priority: contact (name part only) -> provider -> "openaerialmap.org"
     """
-    # Try contact first (extract name part before comma)
-    if 'contact' in row and pd.notna(row['contact']) and str(row['contact']).strip():
-        contact_str = str(row['contact']).strip()
-        if ',' in contact_str:
-            # Extract name part (before comma)
-            name_part = contact_str.split(',')[0].strip()
-            if name_part:
-                return name_part
-        else:
-            # No comma, use whole string
-            return contact_str
+    # Name part of contact (before comma); blank name parts fall through to provider
+    contact_names = _stripped_or_na(df, 'contact').str.split(',', n=1).str[0].str.strip()
+    contact_names = contact_names.mask(contact_names.eq(''))
     
-    # Fallback to provider
-    if 'provider' in row and pd.notna(row['provider']) and str(row['provider']).strip():
-        return str(row['provider']).strip()
+    return contact_names.fillna(_stripped_or_na(df, 'provider')).fillna("openaerialmap.org")
+
+def _local_date(value):
+    """Format one timestamp string as YYYY-MM-DD in its own offset (None if unparseable)."""
+    date_obj = pd.to_datetime(value, errors='coerce')
+    return date_obj.strftime('%Y-%m-%d') if pd.notna(date_obj) else None
+
+def format_capture_dates(df):
+    """
+    Format acquisition_start as YYYY-MM-DD for all CSV rows ('' if missing or unparseable).
+    The date is the one written in the timestamp (its own offset), not the UTC date.
+    """
+    starts = _stripped_or_na(df, 'acquisition_start')
+    # The UTC parse only decides which values are valid; converting to UTC would move e.g. 23:00-05:00 to the next day
+    valid = _parse_dates(df, 'acquisition_start').notna()
+    dates = starts.str.extract(r'^(\d{4}-\d{2}-\d{2})(?=[T ]|$)', expand=False).where(valid)
     
-    # Default fallback
-    return "openaerialmap.org"
+    # Values that are not ISO-like are rare; parse those one by one in their own offset
+    other = valid & dates.isna()
+    if other.any():
+        dates[other] = starts[other].map(_local_date)
+    return dates.fillna('')
 
-def is_long_campaign(row):
+def flag_long_campaigns(df):
     """
-    Check if acquisition duration is longer than 7 days.
-    Returns True if duration > 7 days, False otherwise.
+    Check for all CSV rows if acquisition duration is longer than 7 days.
+    Rows with a missing or unparseable start/end date are False.
     """
-    try:
-        if 'acquisition_start' not in row or 'acquisition_end' not in row:
-            return False
-        
-        start_str = row['acquisition_start']
-        end_str = row['acquisition_end']
-        
-        if pd.isna(start_str) or pd.isna(end_str):
-            return False
-        
-        start_date = pd.to_datetime(start_str, errors='coerce')
-        end_date = pd.to_datetime(end_str, errors='coerce')
-        
-        if pd.isna(start_date) or pd.isna(end_date):
-            return False
-        
-        duration = end_date - start_date
-        
-        # Check if duration > 7 days
-        return duration > pd.Timedelta(days=7)
-    except Exception as e:
-        logger.warning(f"Error calculating long campaign flag: {e}")
-        return False
+    duration = _parse_dates(df, 'acquisition_end') - _parse_dates(df, 'acquisition_start')
+    return (duration > pd.Timedelta(days=7)).fillna(False).astype(bool)
 
-def main(csv_file, thumbnails_dir, output_dir, delay=0.5, metadata_output=None):
+def main(csv_file, thumbnails_dir, output_dir, rate_per_sec=2.0, metadata_output=None, workers=16, revalidate=False):
     """
     Main function to download TIF files based on thumbnail filenames.
     
@@ -102,8 +124,10 @@ def main(csv_file, thumbnails_dir, output_dir, delay=0.5, metadata_output=None):
         csv_file: Path to CSV file with uuid column
         thumbnails_dir: Directory containing thumbnail PNG files
         output_dir: Directory to save TIF files
-        delay: Delay between downloads in seconds
+        rate_per_sec: Average request rate across all workers (<= 0 disables limiting)
         metadata_output: Path to output metadata CSV file (default: {output_dir}/tif_metadata.csv)
+        workers: Number of concurrent download workers
+        revalidate: Re-request existing TIFs with known ETag/Last-Modified instead of skipping them
     """
     # Load CSV
     try:
@@ -120,6 +144,12 @@ def main(csv_file, thumbnails_dir, output_dir, delay=0.5, metadata_output=None):
     # Create output directory
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     
+    # List existing TIFs once instead of stat-ing every output path in the loop
+    with os.scandir(output_dir) as entries:
+        existing_tifs = {entry.name for entry in entries if entry.name.endswith('.tif')}
+    
+    cache = DownloadCache(os.path.join(output_dir, "download_cache.json"))
+    
     # Get list of thumbnail files
     if not os.path.exists(thumbnails_dir):
         logger.error(f"Thumbnails directory not found: {thumbnails_dir}")
@@ -144,33 +174,83 @@ def main(csv_file, thumbnails_dir, output_dir, delay=0.5, metadata_output=None):
     # Load existing metadata CSV if it exists
     existing_metadata = {}
     existing_filenames = set()
+    existing_fieldnames = None
     if os.path.exists(metadata_output):
         try:
-            existing_df = pd.read_csv(metadata_output)
-            if 'filename' in existing_df.columns:
-                for _, existing_row in existing_df.iterrows():
-                    filename = existing_row['filename']
-                    existing_metadata[filename] = existing_row.to_dict()
-                    existing_filenames.add(filename)
-                logger.info(f"Loaded {len(existing_filenames)} existing metadata entries from {metadata_output}")
+            # Stream rows straight into the dict; no DataFrame is needed just to iterate them
+            with open(metadata_output, newline='') as fh:
+                reader = csv.DictReader(fh)
+                if reader.fieldnames and 'filename' in reader.fieldnames:
+                    existing_fieldnames = reader.fieldnames
+                    for existing_row in reader:
+                        filename = existing_row['filename']
+                        existing_metadata[filename] = existing_row
+                        existing_filenames.add(filename)
+                    logger.info(f"Loaded {len(existing_filenames)} existing metadata entries from {metadata_output}")
         except Exception as e:
             logger.warning(f"Could not load existing metadata CSV: {e}")
     
-    # Initialize metadata list for all TIF files in directory
-    metadata_list = []
+    # Metadata for all TIF files in directory, keyed by filename (later writes replace earlier ones)
+    merged_metadata = dict(existing_metadata)
+    
+    # Derive per-row metadata fields once for the whole DataFrame instead of per entry,
+    # reading them by row position from NumPy arrays rather than via Series
+    authors_by_row = extract_authors(df).to_numpy()
+    capture_dates = format_capture_dates(df).to_numpy()
+    long_campaigns = flag_long_campaigns(df).to_numpy()
+    platforms = df['platform'].fillna('').to_numpy() if 'platform' in df.columns else None
+    uuids = df['uuid'].to_numpy()
+    
+    # All original CSV columns with NaN values as '', converted in one vectorized pass;
+    # our custom fields are dropped so they are not overwritten by the CSV values
+    custom_fields = ['filename', 'authors', 'capture_date', 'platform', 'is_long_campaign']
+    row_records = df.drop(columns=[c for c in custom_fields if c in df.columns]).fillna('').to_dict('records')
+    
+    # Helper function to create metadata entry
+    def create_metadata_entry(idx, filename):
+        """Create metadata entry from CSV row position and filename."""
+        metadata_entry = {
+            'filename': filename,
+            'authors': authors_by_row[idx],
+            'capture_date': capture_dates[idx],
+            'platform': platforms[idx] if platforms is not None else '',
+            'is_long_campaign': bool(long_campaigns[idx])
+        }
+        metadata_entry.update(row_records[idx])
+        return metadata_entry
+    
+    # TIFs that still need downloading: (row position, url, filename, output path)
+    pending_downloads = []
+    queued_filenames = set()
+    
+    # Index CSV rows by the TIF base name of their uuid URL (first occurrence wins),
+    # using vectorized string ops instead of parsing each URL in Python
+    uuid_bases = (
+        df['uuid'].fillna('').astype(str)
+        .str.split('?', n=1).str[0]
+        .str.rsplit('/', n=1).str[-1]
+        .str.removesuffix('.tif')
+    )
+    first_occurrence = (~uuid_bases.duplicated() & uuid_bases.ne('')).to_numpy()
+    base_to_idx = dict(zip(uuid_bases.to_numpy()[first_occurrence], np.flatnonzero(first_occurrence)))
     
     for base_name, thumbnail_file in thumbnail_bases.items():
-        # Find matching row in CSV where uuid contains the base name
-        matching_rows = df[df['uuid'].str.contains(base_name, na=False)]
-        
-        if len(matching_rows) == 0:
-            logger.warning(f"No matching CSV row for thumbnail: {thumbnail_file}")
-            not_found_count += 1
-            continue
+        idx = base_to_idx.get(base_name)
         
-        # Use first match
-        row = matching_rows.iloc[0]
-        tif_url = row['uuid']
+        if idx is None:
+            # Fall back to a substring scan for thumbnails not named after the TIF
+            matching_positions = np.flatnonzero(
+                df['uuid'].str.contains(base_name, na=False, regex=False).to_numpy(dtype=bool)
+            )
+            
+            if len(matching_positions) == 0:
+                logger.warning(f"No matching CSV row for thumbnail: {thumbnail_file}")
+                not_found_count += 1
+                continue
+            
+            # Use first match
+            idx = matching_positions[0]
+        tif_url = uuids[idx]
         
         # Extract filename from URL
         parsed_url = urlparse(tif_url)
@@ -181,46 +261,15 @@ def main(csv_file, thumbnails_dir, output_dir, delay=0.5, metadata_output=None):
         
         output_path = os.path.join(output_dir, tif_filename)
         
-        # Helper function to create metadata entry
-        def create_metadata_entry(row, filename):
-            """Create metadata entry from CSV row and filename."""
-            authors = extract_author(row)
-            
-            # Extract and format capture_date as YYYY-MM-DD only
-            capture_date = ''
-            if 'acquisition_start' in row and pd.notna(row.get('acquisition_start')):
-                try:
-                    date_obj = pd.to_datetime(row['acquisition_start'], errors='coerce')
-                    if pd.notna(date_obj):
-                        capture_date = date_obj.strftime('%Y-%m-%d')
-                except Exception:
-                    capture_date = ''
-            
-            platform = row.get('platform', '') if pd.notna(row.get('platform')) else ''
-            long_campaign = is_long_campaign(row)
-            
-            metadata_entry = {
-                'filename': filename,
-                'authors': authors,
-                'capture_date': capture_date,
-                'platform': platform,
-                'is_long_campaign': long_campaign
-            }
-            
-            # Add all original CSV columns
-            for col in df.columns:
-                if col not in metadata_entry:  # Don't overwrite our custom fields
-                    value = row.get(col, '')
-                    # Handle NaN values
-                    if pd.isna(value):
-                        metadata_entry[col] = ''
-                    else:
-                        metadata_entry[col] = value
-            
-            return metadata_entry
+        # Another thumbnail already queued this TIF; only that download's success adds its metadata row
+        if tif_filename in queued_filenames:
+            logger.info(f"Already queued by another thumbnail: {tif_filename}")
+            continue
         
         # Check if file already exists
-        file_exists = os.path.exists(output_path)
+        file_exists = tif_filename in existing_tifs
+        if revalidate and file_exists and cache.get(tif_filename):
+            file_exists = False
         
         if file_exists:
             logger.info(f"File already exists, skipping download: {tif_filename}")
@@ -228,51 +277,79 @@ def main(csv_file, thumbnails_dir, output_dir, delay=0.5, metadata_output=None):
             
             # Add metadata if not already in existing metadata
             if tif_filename not in existing_filenames:
-                metadata_entry = create_metadata_entry(row, tif_filename)
-                metadata_list.append(metadata_entry)
+                merged_metadata[tif_filename] = create_metadata_entry(idx, tif_filename)
         else:
-            # Download TIF
+            pending_downloads.append((idx, tif_url, tif_filename, output_path))
+            queued_filenames.add(tif_filename)
+    
+    # Download TIFs concurrently; the token bucket keeps the overall request rate polite
+    rate_limiter = TokenBucket(rate_per_sec)
+    set_pool_size(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for idx, tif_url, tif_filename, output_path in pending_downloads:
             logger.info(f"Downloading {tif_filename}...")
-            if download_tif(tif_url, output_path):
+            future = executor.submit(download_tif, tif_url, output_path, rate_limiter, cache)
+            futures[future] = (idx, tif_filename)
+        
+        for future in as_completed(futures):
+            idx, tif_filename = futures[future]
+            status = future.result()
+            if status == DOWNLOADED:
                 downloaded_count += 1
+                existing_tifs.add(tif_filename)
                 
                 # Add metadata for newly downloaded file
-                metadata_entry = create_metadata_entry(row, tif_filename)
-                metadata_list.append(metadata_entry)
+                merged_metadata[tif_filename] = create_metadata_entry(idx, tif_filename)
+            elif status == SKIPPED:
+                # Unchanged on the server: count it like an existing file and keep its metadata row as is
+                skipped_count += 1
+                if tif_filename not in existing_filenames:
+                    merged_metadata[tif_filename] = create_metadata_entry(idx, tif_filename)
             else:
                 failed_count += 1
-        
-        # Delay between downloads
-        if delay > 0:
-            time.sleep(delay)
+    cache.save()
     
     logger.info(f"\nDownload Summary:")
     logger.info(f"Successfully downloaded: {downloaded_count}")
     logger.info(f"Failed to download: {failed_count}")
-    logger.info(f"Skipped (already existed): {skipped_count}")
+    logger.info(f"Skipped (already existed or not modified): {skipped_count}")
     logger.info(f"Not found in CSV: {not_found_count}")
     logger.info(f"Total processed: {downloaded_count + failed_count + skipped_count + not_found_count}")
     
-    # Merge existing and new metadata
+    # Save merged metadata (already deduplicated by filename)
     try:
-        # Add all existing metadata entries
-        for filename, existing_entry in existing_metadata.items():
-            metadata_list.append(existing_entry)
+        new_filenames = merged_metadata.keys() - existing_filenames
+        new_entries = [merged_metadata[filename] for filename in sorted(new_filenames, key=str)]
+        replaced_existing = any(merged_metadata[f] is not existing_metadata[f] for f in existing_filenames)
+        
+        # Append only the new rows when no existing row changed and the columns still match;
+        # appended rows stay at the end until the next full rewrite re-sorts the file
+        can_append = (
+            existing_fieldnames is not None
+            and not replaced_existing
+            and all(set(entry) == set(existing_fieldnames) for entry in new_entries)
+        )
         
-        if metadata_list:
-            # Create DataFrame and remove duplicates (keep last occurrence, which would be newly added/updated)
-            metadata_df = pd.DataFrame(metadata_list)
-            # Remove duplicates based on filename, keeping the last occurrence
-            metadata_df = metadata_df.drop_duplicates(subset='filename', keep='last')
+        if can_append:
+            if new_entries:
+                with open(metadata_output, 'a', newline='') as fh:
+                    writer = csv.DictWriter(fh, fieldnames=existing_fieldnames, lineterminator='\n')
+                    writer.writerows(new_entries)
+            logger.info(f"\nMetadata CSV updated: {metadata_output}")
+            logger.info(f"Total metadata entries: {len(merged_metadata)}")
+            if new_entries:
+                logger.info(f"Added {len(new_entries)} new metadata entries")
+        elif merged_metadata:
             # Sort by filename for consistency
-            metadata_df = metadata_df.sort_values('filename').reset_index(drop=True)
+            sorted_entries = [merged_metadata[filename] for filename in sorted(merged_metadata, key=str)]
+            metadata_df = pd.DataFrame.from_records(sorted_entries)
             
             metadata_df.to_csv(metadata_output, index=False)
             logger.info(f"\nMetadata CSV saved: {metadata_output}")
             logger.info(f"Total metadata entries: {len(metadata_df)}")
-            if len(metadata_list) > len(existing_filenames):
-                new_entries = len(metadata_list) - len(existing_filenames)
-                logger.info(f"Added {new_entries} new metadata entries")
+            if new_entries:
+                logger.info(f"Added {len(new_entries)} new metadata entries")
         else:
             logger.info("\nNo metadata to save")
     except Exception as e:
@@ -283,10 +360,12 @@ if __name__ == "__main__":
     parser.add_argument("--csv", default="results_gee_filtered.csv", help="CSV file path")
     parser.add_argument("--thumbnails-dir", default="thumbnails", help="Directory containing thumbnails")
     parser.add_argument("--output-dir", default="tifs", help="Output directory for TIF files")
-    parser.add_argument("--delay", type=float, default=0.5, help="Delay between downloads in seconds")
+    parser.add_argument("--rate-per-sec", type=float, default=2.0, help="Average download requests per second across all workers (0 = unlimited)")
     parser.add_argument("--metadata-output", default=None, help="Output path for metadata CSV (default: {output_dir}/tif_metadata.csv)")
+    parser.add_argument("--workers", type=int, default=16, help="Number of concurrent download workers")
+    parser.add_argument("--revalidate", action="store_true", help="Re-check existing TIFs with conditional requests instead of skipping them")
     
     args = parser.parse_args()
     
-    main(args.csv, args.thumbnails_dir, args.output_dir, args.delay, args.metadata_output)
+    main(args.csv, args.thumbnails_dir, args.output_dir, args.rate_per_sec, args.metadata_output, args.workers, args.revalidate)
 
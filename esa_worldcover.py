@@ -1,34 +1,34 @@
+import re
+import time
 import ee
 from typing import Optional, Sequence
+from tqdm.contrib.concurrent import thread_map
+from json_cache import JsonFileCache
+
+# Signed decimal or scientific-notation number
+_BBOX_NUMBER_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
 
 def parse_bbox_string(bbox_str: str) -> Optional[Sequence[float]]:
     """Parse bbox string '[min_lon, min_lat, max_lon, max_lat]' or '[min_lon min_lat max_lon max_lat]' -> list of floats."""
-    if bbox_str is None:
-        return None
-    try:
-        # Remove brackets and split by comma or whitespace
-        cleaned = bbox_str.strip("[]")
-        # Try splitting by comma first, then by whitespace
-        if ',' in cleaned:
-            coords = [float(c.strip()) for c in cleaned.split(',')]
-        else:
-            coords = [float(c) for c in cleaned.split()]
-        if len(coords) == 4:
-            return coords
-    except (ValueError, AttributeError):
+    if not isinstance(bbox_str, str):
         return None
-    return None
+    numbers = _BBOX_NUMBER_RE.findall(bbox_str)
+    return [float(n) for n in numbers] if len(numbers) == 4 else None
 
-def init_earthengine(authenticate_if_needed=False):
-    """Initialize Earth Engine. Returns True if successful."""
+# Endpoint tuned for many small/parallel requests (as opposed to interactive use)
+HIGH_VOLUME_URL = "https://earthengine-highvolume.googleapis.com"
+
+def init_earthengine(authenticate_if_needed=False, high_volume=False):
+    """Initialize Earth Engine, optionally against the high-volume endpoint. Returns True if successful."""
+    opt_url = HIGH_VOLUME_URL if high_volume else None
     try:
-        ee.Initialize(project="earth-engine-481316")
+        ee.Initialize(project="earth-engine-481316", opt_url=opt_url)
         return True
     except Exception as e:
         if authenticate_if_needed:
             try:
                 ee.Authenticate()
-                ee.Initialize(project="earth-engine-481316")
+                ee.Initialize(project="earth-engine-481316", opt_url=opt_url)
                 return True
             except Exception as e2:
                 print(f"Earth Engine initialization failed: {e2}")
@@ -38,6 +38,7 @@ def init_earthengine(authenticate_if_needed=False):
 # Load ESA WorldCover 2021
 _worldcover = None
 _forest_mask = None
+_mean_reducer = None
 
 def _get_forest_mask():
     """Get or create forest mask."""
@@ -48,6 +49,36 @@ def _get_forest_mask():
         _forest_mask = _worldcover.eq(10).Or(_worldcover.eq(95))
     return _forest_mask
 
+def _get_mean_reducer():
+    """Get or create the mean reducer shared by all forest percentage requests."""
+    global _mean_reducer
+    if _mean_reducer is None:
+        _mean_reducer = ee.Reducer.mean()
+    return _mean_reducer
+
+class ForestPercentageCache(JsonFileCache):
+    """
+    On-disk cache of forest percentages keyed by bbox (rounded to 5 decimals, ~1 m),
+    so reruns and repeated bboxes do not query Earth Engine again.
+    """
+
+    def __init__(self, path="forest_cache.json"):
+        super().__init__(path)
+
+    @staticmethod
+    def key(bbox_coords):
+        """Cache key for a bbox."""
+        return ','.join(f"{round(float(c), 5):.5f}" for c in bbox_coords)
+
+    def get(self, bbox_coords):
+        """Return the cached forest % for a bbox, or None."""
+        return super().get(self.key(bbox_coords))
+
+    def set(self, bbox_coords, percentage):
+        """Store a forest % for a bbox (failed lookups, i.e. None, are not cached)."""
+        if percentage is not None:
+            super().set(self.key(bbox_coords), percentage)
+
 def calculate_forest_percentage(bbox_coords):
     """Compute forest % for bbox coordinates using Earth Engine."""
     if bbox_coords is None:
@@ -59,7 +90,7 @@ def calculate_forest_percentage(bbox_coords):
     
     try:
         stats = forest_mask.reduceRegion(
-            reducer=ee.Reducer.mean(),
+            reducer=_get_mean_reducer(),
             geometry=region,
             scale=10,
             maxPixels=1e9
@@ -71,3 +102,90 @@ def calculate_forest_percentage(bbox_coords):
         print(f"Error calculating forest percentage: {e}")
         return None
 
+def _reduce_forest_batch(batch, retries=3, backoff_factor=1.0):
+    """
+    Reduce one batch of (key, bbox) pairs server-side. Returns {key: forest %}.
+    Failed requests (e.g. rate limits when batches run concurrently) are retried with exponential backoff;
+    a batch that keeps failing is split in half so only the bboxes that really fail are left out.
+    """
+    fc = ee.FeatureCollection([
+        ee.Feature(ee.Geometry.Rectangle(list(bbox)), {'key': key}) for key, bbox in batch
+    ])
+    
+    for attempt in range(retries):
+        try:
+            result = _get_forest_mask().reduceRegions(
+                collection=fc,
+                reducer=_get_mean_reducer(),
+                scale=10
+            ).getInfo()
+            break
+        except Exception as e:
+            error = e
+            if attempt < retries - 1:
+                time.sleep(backoff_factor * 2 ** attempt)
+    else:
+        if len(batch) == 1:
+            print(f"Error calculating forest percentage for bbox {batch[0][1]}: {error}")
+            return {}
+        mid = len(batch) // 2
+        print(f"Batch of {len(batch)} bboxes failed after {retries} attempts ({error}); splitting it")
+        percentages = _reduce_forest_batch(batch[:mid], retries, backoff_factor)
+        percentages.update(_reduce_forest_batch(batch[mid:], retries, backoff_factor))
+        return percentages
+    
+    percentages = {}
+    for feature in result.get('features', []):
+        properties = feature.get('properties', {})
+        forest_fraction = properties.get('mean')
+        percentages[properties['key']] = float(forest_fraction) * 100 if forest_fraction is not None else 0.0
+    return percentages
+
+def calculate_forest_percentage_batch(bbox_list, batch_size=1000, cache=None, max_workers=8):
+    """
+    Compute forest % for many bboxes, reducing up to batch_size regions per Earth Engine request
+    and keeping up to max_workers requests in flight.
+    With a cache, cached bboxes are answered locally and only unique cache misses are sent.
+    Returns a list aligned with bbox_list; None for missing bboxes or bboxes whose requests kept failing.
+    """
+    percentages = [None] * len(bbox_list)
+    
+    # Group positions by bbox so each distinct bbox is only reduced once
+    positions_by_key = {}
+    bbox_by_key = {}
+    cache_hits = 0
+    for i, bbox in enumerate(bbox_list):
+        if bbox is None:
+            continue
+        if cache is not None:
+            cached = cache.get(bbox)
+            if cached is not None:
+                percentages[i] = cached
+                cache_hits += 1
+                continue
+        key = ForestPercentageCache.key(bbox)
+        positions_by_key.setdefault(key, []).append(i)
+        bbox_by_key.setdefault(key, bbox)
+    
+    valid = list(bbox_by_key.items())
+    if cache is not None:
+        print(f"Forest percentage cache: {cache_hits} hits, {len(valid)} unique bboxes to query")
+    if not valid:
+        return percentages
+    
+    # Build the shared EE objects once before the worker threads use them
+    _get_forest_mask()
+    _get_mean_reducer()
+    
+    batches = [valid[start:start + batch_size] for start in range(0, len(valid), batch_size)]
+    batch_results = thread_map(_reduce_forest_batch, batches, max_workers=max_workers,
+                               desc="Calculating forest percentages", unit="batch")
+    
+    for batch_percentages in batch_results:
+        for key, percentage in batch_percentages.items():
+            for i in positions_by_key[key]:
+                percentages[i] = percentage
+            if cache is not None:
+                cache.set(bbox_by_key[key], percentage)
+    
+    return percentages
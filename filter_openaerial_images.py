@@ -1,5 +1,6 @@
+import numpy as np
 import pandas as pd
-from esa_worldcover import parse_bbox_string, calculate_forest_percentage, init_earthengine
+from esa_worldcover import parse_bbox_string, calculate_forest_percentage_batch, init_earthengine, ForestPercentageCache
 
 def filter_openaerial_data(df, max_gsd_cm=10, uploaded_after_date='2000-01-01', platform_type='uav'):
     """
@@ -17,74 +18,94 @@ def filter_openaerial_data(df, max_gsd_cm=10, uploaded_after_date='2000-01-01',
     """
     initial_records = len(df)
     print(f"\nStarting filtering with {initial_records} records.")
-    filtered_df = df.copy()
+    # Combine boolean masks and index the DataFrame once at the end (no copies or temporary columns)
+    mask = pd.Series(True, index=df.index)
 
     # 1. Filter by resolution (< max_gsd_cm)
-    if 'gsd' in filtered_df.columns:
-        # Convert to numeric, coercing errors to NaN
-        filtered_df['gsd_numeric'] = pd.to_numeric(filtered_df['gsd'], errors='coerce')
-        original_count = len(filtered_df)
-        filtered_df = filtered_df[
-            (filtered_df['gsd_numeric'].notna()) &
-            (filtered_df['gsd_numeric'] < max_gsd_cm / 100.0)
-        ]
-        print(f"  - After GSD filter (< {max_gsd_cm}cm): {len(filtered_df)} records ({(original_count - len(filtered_df))} removed).")
-        filtered_df = filtered_df.drop(columns=['gsd_numeric']) # Clean up temporary column
+    if 'gsd' in df.columns:
+        original_count = int(mask.sum())
+        # Convert to numeric, coercing errors to NaN (NaN compares False)
+        mask &= pd.to_numeric(df['gsd'], errors='coerce').lt(max_gsd_cm / 100.0)
+        remaining = int(mask.sum())
+        print(f"  - After GSD filter (< {max_gsd_cm}cm): {remaining} records ({(original_count - remaining)} removed).")
     else:
         print("  - Warning: 'gsd' column not found for resolution filtering. Skipping.")
 
     # 2. Filter by uploaded_at date (> uploaded_after_date)
     # Assuming 'uploaded_at' exists as a string timestamp.
-    if 'uploaded_at' in filtered_df.columns:
-        original_count = len(filtered_df)
-        # Convert 'uploaded_at' to datetime and compare
-        target_date = pd.to_datetime(uploaded_after_date, utc=True) # Add utc=True here
-        filtered_df['uploaded_datetime'] = pd.to_datetime(filtered_df['uploaded_at'], errors='coerce')
-        filtered_df = filtered_df[
-            (filtered_df['uploaded_datetime'].notna()) &
-            (filtered_df['uploaded_datetime'] > target_date)
-        ]
-        print(f"  - After uploaded date filter (> {uploaded_after_date}): {len(filtered_df)} records ({(original_count - len(filtered_df))} removed).")
-        filtered_df = filtered_df.drop(columns=['uploaded_datetime']) # Drop the temporary column
+    if 'uploaded_at' in df.columns:
+        original_count = int(mask.sum())
+        # Convert 'uploaded_at' to datetime and compare (NaT compares False)
+        target_date = pd.to_datetime(uploaded_after_date, utc=True)
+        mask &= pd.to_datetime(df['uploaded_at'], errors='coerce', utc=True, format='ISO8601').gt(target_date)
+        remaining = int(mask.sum())
+        print(f"  - After uploaded date filter (> {uploaded_after_date}): {remaining} records ({(original_count - remaining)} removed).")
     else:
         print("  - Warning: 'uploaded_at' column not found for uploaded date filtering. Skipping.")
 
     # 3. Filter by platform (e.g., 'uav' or ['uav', 'aircraft'])
     # Assuming 'platform' column exists. Perform case-insensitive comparison.
-    if 'platform' in filtered_df.columns:
-        original_count = len(filtered_df)
+    if 'platform' in df.columns:
+        original_count = int(mask.sum())
         # Handle both string and list inputs
         if isinstance(platform_type, str):
             platform_types = [platform_type.lower()]
         else:
             platform_types = [p.lower() if isinstance(p, str) else str(p).lower() for p in platform_type]
         
-        filtered_df = filtered_df[
-            (filtered_df['platform'].notna()) &
-            (filtered_df['platform'].str.lower().isin(platform_types))
-        ]
+        # Lower-case only the (few) categories, then match rows by their integer category codes
+        platform = df['platform']
+        if not isinstance(platform.dtype, pd.CategoricalDtype):
+            platform = platform.astype('category')
+        categories = platform.cat.categories.astype(str).str.lower()
+        allowed_codes = np.flatnonzero(categories.isin(platform_types))
+        mask &= platform.cat.codes.isin(allowed_codes)
+        remaining = int(mask.sum())
         platform_str = platform_type if isinstance(platform_type, str) else ', '.join(platform_type)
-        print(f"  - After platform filter ('{platform_str}'): {len(filtered_df)} records ({(original_count - len(filtered_df))} removed).")
+        print(f"  - After platform filter ('{platform_str}'): {remaining} records ({(original_count - remaining)} removed).")
     else:
         print("  - Warning: 'platform' column not found for platform filtering. Skipping.")
 
+    filtered_df = df.loc[mask]
     print(f"\nFiltering complete. {len(filtered_df)} records remaining out of {initial_records} initial records.")
     return filtered_df
 
+BBOX_COLUMNS = ['bbox_min_lon', 'bbox_min_lat', 'bbox_max_lon', 'bbox_max_lat']
+
+def extract_bboxes(df):
+    """
+    Get one [min_lon, min_lat, max_lon, max_lat] list (or None) per row.
+    Reads the typed bbox_* columns as a single float array; the 'bbox' string is only parsed for rows
+    where those columns are missing.
+    """
+    if not set(BBOX_COLUMNS).issubset(df.columns):
+        return [parse_bbox_string(x) for x in df['bbox']] if 'bbox' in df.columns else [None] * len(df)
+    
+    coords = df[BBOX_COLUMNS].to_numpy(dtype=float, na_value=np.nan)
+    valid = ~np.isnan(coords).any(axis=1)
+    bboxes = [row if ok else None for row, ok in zip(coords.tolist(), valid)]
+    if 'bbox' in df.columns and not valid.all():
+        bbox_strings = df['bbox'].to_numpy()
+        for i in np.flatnonzero(~valid):
+            bboxes[i] = parse_bbox_string(bbox_strings[i])
+    return bboxes
+
 def main():
-    # Define input and output file names
-    input_csv_file = "openaerial_data.csv"
-    output_csv_file = "openaerial_data_filtered.csv"
+    # Define input file name
+    input_file = "openaerial_data.parquet"
 
-    print(f"Loading data from {input_csv_file}...")
+    print(f"Loading data from {input_file}...")
     try:
-        df = pd.read_csv(input_csv_file)
+        df = pd.read_parquet(input_file)
         print(f"Successfully loaded {len(df)} records.")
+        # Few distinct platforms: store them as categories so filtering works on integer codes
+        if 'platform' in df.columns:
+            df['platform'] = df['platform'].astype('category')
     except FileNotFoundError:
-        print(f"Error: {input_csv_file} not found. Please run scrape.py first to generate the data.")
+        print(f"Error: {input_file} not found. Please run scrape.py first to generate the data.")
         return
     except Exception as e:
-        print(f"Error loading data from {input_csv_file}: {e}")
+        print(f"Error loading data from {input_file}: {e}")
         return
 
     # Print dataset info BEFORE filtering
@@ -109,24 +130,20 @@ def main():
     print(f"Total columns: {len(filtered_df.columns)}")
     print("\nPlatform distribution (after filtering):")
     if 'platform' in filtered_df.columns:
-        print(filtered_df['platform'].value_counts())
-
-    # Save filtered data
-    print(f"\nSaving filtered dataset to {output_csv_file}...")
-    filtered_df.to_csv(output_csv_file, index=False)
-    print(f"Saved filtered CSV version to {output_csv_file}")
+        print(filtered_df['platform'].cat.remove_unused_categories().value_counts())
 
     # Initialize Earth Engine (non-interactive). If not initialized, skip percentage calculation.
-    ee_ready = init_earthengine(authenticate_if_needed=False)
+    ee_ready = init_earthengine(authenticate_if_needed=False, high_volume=True)
     if not ee_ready:
         print("Earth Engine not initialized. Call init_earthengine(authenticate_if_needed=True) or run ee.Authenticate() interactively.")
         filtered_df['forest_percentage_gee'] = None
     else:
-        # Apply the function to each row of the FILTERED DataFrame to get the forest percentage
+        # Reduce all bboxes of the FILTERED DataFrame server-side in batches instead of one request per row
         print("\nCalculating forest percentages for filtered records...")
-        from tqdm import tqdm
-        tqdm.pandas(desc="Calculating forest percentages")
-        filtered_df['forest_percentage_gee'] = filtered_df['bbox'].progress_apply(lambda x: calculate_forest_percentage(parse_bbox_string(x)))
+        bboxes = extract_bboxes(filtered_df)
+        forest_cache = ForestPercentageCache("forest_cache.json")
+        filtered_df['forest_percentage_gee'] = calculate_forest_percentage_batch(bboxes, cache=forest_cache)
+        forest_cache.save()
         
         # Debug: show statistics
         non_null_count = filtered_df['forest_percentage_gee'].notna().sum()
@@ -135,26 +152,21 @@ def main():
             print(f"Forest percentage range: {filtered_df['forest_percentage_gee'].min():.2f}% - {filtered_df['forest_percentage_gee'].max():.2f}%")
             print(f"Mean forest percentage: {filtered_df['forest_percentage_gee'].mean():.2f}%")
 
-    # Convert uploaded_at to datetime if it exists
-    if 'uploaded_at' in filtered_df.columns:
-        filtered_df['uploaded_at'] = pd.to_datetime(filtered_df['uploaded_at'], utc=True)
+    # uploaded_at comes back from Parquet as a datetime; only older files without that dtype need parsing
+    if 'uploaded_at' in filtered_df.columns and not pd.api.types.is_datetime64_any_dtype(filtered_df['uploaded_at']):
+        filtered_df['uploaded_at'] = pd.to_datetime(filtered_df['uploaded_at'], utc=True, format='ISO8601')
 
     # Apply date-based forest filtering (from earth_engine.py)
-    april_2025 = pd.Timestamp('2025-04-01', tz='UTC')
+    april_2025 = np.datetime64('2025-04-01')
     
-    # Filter based on upload_date and forest_percentage_gee
+    # Filter based on upload_date and forest_percentage_gee, evaluated on the backing NumPy arrays
     if 'uploaded_at' in filtered_df.columns and 'forest_percentage_gee' in filtered_df.columns:
         original_count = len(filtered_df)
-        # Handle None values - only filter where forest_percentage_gee is not None
-        mask = filtered_df['forest_percentage_gee'].notna()
-        filtered_mask = mask & (
-            (
-                # Before April 2025: forest_percentage_gee between > 0 and <= 30%
-                ((filtered_df['uploaded_at'] < april_2025) & (filtered_df['forest_percentage_gee'] > 0) & (filtered_df['forest_percentage_gee'] <= 30)) |
-                # After April 2025: forest_percentage_gee > 0%
-                ((filtered_df['uploaded_at'] >= april_2025) & (filtered_df['forest_percentage_gee'] > 0))
-            )
-        )
+        uploaded = filtered_df['uploaded_at'].dt.tz_localize(None).to_numpy()
+        # None/NaN percentages compare False below, so they are filtered out
+        forest = filtered_df['forest_percentage_gee'].to_numpy(dtype=float, na_value=np.nan)
+        # Before April 2025: 0 < forest_percentage_gee <= 30%; after April 2025: forest_percentage_gee > 0%
+        filtered_mask = ~np.isnat(uploaded) & (forest > 0) & ((uploaded >= april_2025) | (forest <= 30))
         filtered_df = filtered_df[filtered_mask].copy()
         print(f"\nAfter forest-based filtering: {len(filtered_df)} records ({(original_count - len(filtered_df))} removed).")
 
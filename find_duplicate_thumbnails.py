@@ -1,13 +1,26 @@
 #!/usr/bin/env python3
 """
-Find exact duplicate thumbnails by comparing file content.
+Find exact duplicate thumbnails by comparing file content,
+or near-duplicates by perceptual hash.
 """
 
 import os
+import sys
 import hashlib
+import mmap
+import subprocess
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
 import argparse
 import logging
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed for --perceptual
+    Image = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -16,21 +29,141 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 def calculate_file_hash(filepath):
-    """Calculate MD5 hash of file content."""
-    hash_md5 = hashlib.md5()
+    """
+    Calculate a content fingerprint of a file.
+    SHA-1 is used for speed only (OpenSSL runs it on the CPU's SHA extensions); it is not a security boundary.
+    """
+    file_hash = hashlib.sha1()
     try:
         with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+            # Hash the memory-mapped file in one update call (mmap cannot map empty files)
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    file_hash.update(memoryview(mm))
+        return file_hash.hexdigest()
+    except Exception as e:
+        logger.error(f"Error reading {filepath}: {e}")
+        return None
+
+# Perceptual hash: 8x8 low-frequency DCT block of a 32x32 grayscale thumbnail, one bit per coefficient
+PHASH_SIZE = 32
+PHASH_BITS = 8
+# DCT-II basis matrix, so the 2D transform is two matrix products
+_n = np.arange(PHASH_SIZE)
+_DCT_MATRIX = np.cos(np.pi * (2 * _n[None, :] + 1) * _n[:, None] / (2 * PHASH_SIZE))
+# Number of set bits in every byte value, for vectorized Hamming distances
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def perceptual_hash_from_pixels(pixels):
+    """Compute a 64-bit perceptual hash from a 32x32 grayscale pixel array."""
+    dct = _DCT_MATRIX @ np.asarray(pixels, dtype=np.float64) @ _DCT_MATRIX.T
+    low = dct[:PHASH_BITS, :PHASH_BITS]
+    bits = (low > np.median(low)).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def calculate_perceptual_hash(filepath):
+    """Calculate the perceptual hash of an image (robust to re-encoding and recompression)."""
+    try:
+        with Image.open(filepath) as img:
+            pixels = img.convert('L').resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS)
+            return perceptual_hash_from_pixels(np.asarray(pixels))
     except Exception as e:
         logger.error(f"Error reading {filepath}: {e}")
         return None
 
-def find_duplicates(thumbnails_dir):
+def group_by_hamming_distance(hashes, max_distance):
+    """
+    Group 64-bit hashes around keepers: in order, each hash not yet grouped becomes a keeper and collects
+    every ungrouped hash within max_distance of it. Every member is therefore within max_distance of its
+    keeper (no transitive chains).
+    
+    Returns:
+        list: Lists of indices into hashes, keeper first, one per group of two or more
+    """
+    hash_array = np.asarray(hashes, dtype=np.uint64)
+    ungrouped = np.ones(len(hash_array), dtype=bool)
+    groups = []
+    
+    for keeper in range(len(hash_array)):
+        if not ungrouped[keeper]:
+            continue
+        ungrouped[keeper] = False
+        candidates = np.flatnonzero(ungrouped)
+        xor = np.bitwise_xor(hash_array[candidates], hash_array[keeper])
+        distances = _POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=-1)
+        members = candidates[distances <= max_distance]
+        if len(members):
+            ungrouped[members] = False
+            groups.append([keeper] + members.tolist())
+    return groups
+
+def find_near_duplicates(thumbnails_dir, max_distance=5, workers=None, exclude=()):
+    """
+    Find near-duplicate thumbnails (e.g. re-encoded copies) by perceptual hash.
+    
+    Args:
+        thumbnails_dir: Directory containing thumbnails
+        max_distance: Maximum Hamming distance between a file's perceptual hash and its set's kept file
+        workers: Number of hashing threads (default: 4 per CPU)
+        exclude: Filepaths to leave out (e.g. exact duplicates that are already handled)
+    
+    Returns:
+        dict: {hash: [list of filepaths in the near-duplicate set, kept file first]}
+    """
+    if not os.path.exists(thumbnails_dir):
+        logger.error(f"Directory not found: {thumbnails_dir}")
+        return {}
+    
+    exclude = set(exclude)
+    with os.scandir(thumbnails_dir) as it:
+        png_files = sorted(e.path for e in it
+                           if e.name.endswith('.png') and e.is_file() and e.path not in exclude)
+    logger.info(f"Computing perceptual hashes for {len(png_files)} PNG files")
+    
+    if workers is None:
+        workers = (os.cpu_count() or 1) * 4
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(calculate_perceptual_hash, png_files))
+    
+    hashed = [(h, fp) for h, fp in zip(hashes, png_files) if h is not None]
+    groups = group_by_hamming_distance([h for h, _ in hashed], max_distance)
+    
+    # Files are in path order and the keeper is the first file of its group, so files[0] is always kept
+    duplicates = {}
+    for members in groups:
+        duplicates[f"{hashed[members[0]][0]:016x}"] = [hashed[i][1] for i in members]
+    return duplicates
+
+def reflink_duplicate(keeper, duplicate):
+    """
+    Replace duplicate with a copy-on-write clone of keeper (reflink on btrfs/XFS, clonefile on APFS),
+    so both names share one copy of the data. The duplicate's timestamps are preserved.
+    
+    Returns:
+        bool: True if the clone replaced the duplicate, False if the filesystem does not support it
+    """
+    clone_flag = '-c' if sys.platform == 'darwin' else '--reflink=always'
+    tmp_path = duplicate + '.reflink'
+    try:
+        st = os.stat(duplicate)
+        subprocess.run(['cp', clone_flag, keeper, tmp_path], check=True, capture_output=True)
+        os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        # Swap the clone in atomically so the duplicate is never missing
+        os.replace(tmp_path, duplicate)
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+def find_duplicates(thumbnails_dir, workers=None):
     """
     Find exact duplicate thumbnails.
     
+    Args:
+        thumbnails_dir: Directory containing thumbnails
+        workers: Number of hashing threads (default: 4 per CPU; file reads and hashlib release the GIL)
+    
     Returns:
         dict: {hash: [list of filepaths with same hash]}
     """
@@ -38,25 +171,44 @@ def find_duplicates(thumbnails_dir):
         logger.error(f"Directory not found: {thumbnails_dir}")
         return {}
     
-    # Get all PNG files
-    png_files = [f for f in os.listdir(thumbnails_dir) if f.endswith('.png')]
-    logger.info(f"Found {len(png_files)} PNG files")
+    # Get all PNG files (scandir entries carry file type and cache their stat result)
+    with os.scandir(thumbnails_dir) as it:
+        png_entries = [e for e in it if e.name.endswith('.png') and e.is_file()]
+    logger.info(f"Found {len(png_entries)} PNG files")
+    
+    # Group by file size first: only files sharing a size can be duplicates, so unique sizes are never read
+    size_groups = defaultdict(list)
+    for entry in png_entries:
+        try:
+            size_groups[entry.stat().st_size].append(entry.path)
+        except OSError as e:
+            logger.error(f"Error reading {entry.path}: {e}")
+    candidates = [fp for files in size_groups.values() if len(files) > 1 for fp in files]
+    logger.info(f"Hashing {len(candidates)} files that share a size with another file")
+    
+    # Calculate hashes concurrently, collecting flat (hash, path) pairs
+    if workers is None:
+        workers = (os.cpu_count() or 1) * 4
     
-    # Calculate hashes
-    hash_to_files = defaultdict(list)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pairs = [(file_hash, filepath)
+                 for file_hash, filepath in zip(executor.map(calculate_file_hash, candidates), candidates)
+                 if file_hash]
     
-    for filename in png_files:
-        filepath = os.path.join(thumbnails_dir, filename)
-        file_hash = calculate_file_hash(filepath)
-        if file_hash:
-            hash_to_files[file_hash].append(filepath)
+    # One sort groups equal hashes together and orders each set by path, so the same file is always kept
+    pairs.sort()
     
     # Find duplicates (hashes with more than one file)
-    duplicates = {h: files for h, files in hash_to_files.items() if len(files) > 1}
+    duplicates = {}
+    for file_hash, group in groupby(pairs, key=itemgetter(0)):
+        files = [filepath for _, filepath in group]
+        if len(files) > 1:
+            duplicates[file_hash] = files
     
     return duplicates
 
-def main(thumbnails_dir, remove=False, output_file=None):
+def main(thumbnails_dir, remove=False, output_file=None, workers=None, reflink=False, perceptual=False,
+         max_distance=5):
     """
     Main function to find and optionally remove duplicate thumbnails.
     
@@ -64,20 +216,37 @@ def main(thumbnails_dir, remove=False, output_file=None):
         thumbnails_dir: Directory containing thumbnails
         remove: If True, remove duplicate files (keep first one)
         output_file: Optional file to save list of duplicates
+        workers: Number of hashing threads (default: 4 per CPU)
+        reflink: If True, replace exact duplicate files with reflinks to the kept file, keeping every
+                 filename. Where reflinks are unsupported, duplicates are only removed if remove is also True.
+                 Near-duplicates are never reflinked; they are only removed with remove=True
+        perceptual: If True, also match near-duplicates by perceptual hash (requires Pillow)
+        max_distance: Maximum Hamming distance between a near-duplicate and its set's kept file
     """
-    duplicates = find_duplicates(thumbnails_dir)
+    if perceptual and Image is None:
+        logger.warning("Pillow is not installed; falling back to exact duplicate detection")
+        perceptual = False
+    
+    duplicates = find_duplicates(thumbnails_dir, workers)
+    duplicate_sets = [(file_hash, files, "Duplicate") for file_hash, files in duplicates.items()]
+    
+    if perceptual:
+        # Exact duplicates that will be removed are not matched again; their kept files still are
+        already_duplicates = [filepath for files in duplicates.values() for filepath in files[1:]]
+        near_duplicates = find_near_duplicates(thumbnails_dir, max_distance, workers, already_duplicates)
+        duplicate_sets += [(file_hash, files, "Near-duplicate") for file_hash, files in near_duplicates.items()]
     
-    if not duplicates:
-        logger.info("No exact duplicates found!")
+    if not duplicate_sets:
+        logger.info("No exact or near duplicates found!" if perceptual else "No exact duplicates found!")
         return
     
-    total_duplicates = sum(len(files) - 1 for files in duplicates.values())
-    logger.info(f"\nFound {len(duplicates)} sets of duplicates ({total_duplicates} duplicate files)")
+    total_duplicates = sum(len(files) - 1 for _, files, _ in duplicate_sets)
+    logger.info(f"\nFound {len(duplicate_sets)} sets of duplicates ({total_duplicates} duplicate files)")
     
     # Print duplicates
     duplicate_list = []
-    for file_hash, files in duplicates.items():
-        logger.info(f"\nDuplicate set (hash: {file_hash[:8]}...):")
+    for file_hash, files, kind in duplicate_sets:
+        logger.info(f"\n{kind} set (hash: {file_hash[:8]}...):")
         for i, filepath in enumerate(files):
             filename = os.path.basename(filepath)
             if i == 0:
@@ -92,8 +261,8 @@ def main(thumbnails_dir, remove=False, output_file=None):
         with open(output_file, 'w') as f:
             f.write("Duplicate Thumbnails\n")
             f.write("=" * 50 + "\n\n")
-            for file_hash, files in duplicates.items():
-                f.write(f"Hash: {file_hash}\n")
+            for file_hash, files, kind in duplicate_sets:
+                f.write(f"{'Hash' if kind == 'Duplicate' else 'Perceptual hash'}: {file_hash}\n")
                 for i, filepath in enumerate(files):
                     filename = os.path.basename(filepath)
                     status = "KEEP" if i == 0 else "DUPLICATE"
@@ -101,27 +270,58 @@ def main(thumbnails_dir, remove=False, output_file=None):
                 f.write("\n")
         logger.info(f"\nDuplicate list saved to {output_file}")
     
-    # Remove duplicates if requested
-    if remove:
+    # Remove duplicates (or reflink them to the kept file) if requested
+    if remove or reflink:
         removed_count = 0
-        for file_hash, files in duplicates.items():
+        reflinked_count = 0
+        # Cleared after the first failed clone, so an unsupported filesystem is not retried for every file
+        reflink_supported = reflink
+        for file_hash, files, kind in duplicate_sets:
+            # A clone of the kept file would change a near-duplicate's content under its own name,
+            # so only byte-identical sets are reflinked; near-duplicates are removed only with --remove
+            exact = kind == "Duplicate"
+            if not exact and not remove:
+                logger.info(f"Skipping near-duplicate set {file_hash[:8]}... (only exact duplicates are reflinked)")
+                continue
             # Keep first file, remove rest
             for filepath in files[1:]:
+                if reflink_supported and exact:
+                    if reflink_duplicate(files[0], filepath):
+                        logger.info(f"Reflinked: {os.path.basename(filepath)}")
+                        reflinked_count += 1
+                        continue
+                    reflink_supported = False
+                    logger.warning("Reflinks are not supported here; "
+                                   + ("removing duplicates instead" if remove else "leaving the remaining duplicates in place"))
+                if not remove:
+                    continue
                 try:
                     os.remove(filepath)
                     logger.info(f"Removed: {os.path.basename(filepath)}")
                     removed_count += 1
                 except Exception as e:
                     logger.error(f"Error removing {filepath}: {e}")
-        logger.info(f"\nRemoved {removed_count} duplicate files")
+        if reflink:
+            logger.info(f"\nReflinked {reflinked_count} duplicate files")
+        if remove:
+            logger.info(f"\nRemoved {removed_count} duplicate files")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Find exact duplicate thumbnails")
     parser.add_argument("--thumbnails-dir", default="thumbnails", help="Directory containing thumbnails")
     parser.add_argument("--remove", action="store_true", help="Remove duplicate files (keeps first one)")
+    parser.add_argument("--reflink", action="store_true",
+                        help="Replace exact duplicates with reflinks to the kept file, keeping their names "
+                             "(with --remove, falls back to removing where reflinks are unsupported)")
+    parser.add_argument("--perceptual", action="store_true",
+                        help="Also match near-duplicates (re-encoded copies) by perceptual hash (requires Pillow)")
+    parser.add_argument("--max-distance", type=int, default=5,
+                        help="Maximum Hamming distance between perceptual hashes for --perceptual (default: 5)")
     parser.add_argument("--output", help="Output file to save duplicate list")
+    parser.add_argument("--workers", type=int, default=None, help="Number of hashing threads (default: 4 per CPU)")
     
     args = parser.parse_args()
     
-    main(args.thumbnails_dir, args.remove, args.output)
+    main(args.thumbnails_dir, args.remove, args.output, args.workers, args.reflink, args.perceptual,
+         args.max_distance)
 
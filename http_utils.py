@@ -0,0 +1,147 @@
+import os
+import shutil
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from json_cache import JsonFileCache
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
+
+def mount_adapter(session, pool_size=32, retries=3, backoff_factor=0.3):
+    """Mount a pooled, retrying HTTPAdapter on a session for both http and https."""
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504]
+        )
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def create_session(pool_size=32, retries=3, backoff_factor=0.3):
+    """Create a requests Session with a pooled, retrying HTTPAdapter mounted for http and https."""
+    return mount_adapter(requests.Session(), pool_size, retries, backoff_factor)
+
+# Shared session so downloads reuse keep-alive connections instead of a new TCP+TLS handshake per file
+SESSION = create_session()
+
+def set_pool_size(pool_size):
+    """
+    Resize the shared session's connection pool to match the number of download workers.
+    A pool smaller than the worker count makes urllib3 discard connections and re-handshake.
+    """
+    mount_adapter(SESSION, pool_size=max(pool_size, 1))
+
+class TokenBucket:
+    """
+    Thread-safe token-bucket rate limiter shared by all download workers.
+    Enforces an average of `rate` requests per second while allowing bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it. A rate <= 0 disables limiting."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+class DownloadCache(JsonFileCache):
+    """
+    Persistent filename -> {etag, last_modified, size} map for one download folder.
+    Used to revalidate existing files with conditional requests instead of re-downloading them.
+    """
+
+    def update(self, filename, response, size):
+        """Record the validators of a successful 200 response."""
+        self.set(filename, {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'size': size
+        })
+
+# Outcomes reported by the per-file download helpers
+DOWNLOADED = 'downloaded'
+SKIPPED = 'skipped'  # existing file kept, e.g. the server answered 304 Not Modified
+FAILED = 'failed'
+
+class InvalidContentError(IOError):
+    """Raised when a downloaded body fails the caller's validation (e.g. an HTML error page served with 200)."""
+
+def download_file(url, filepath, cache=None, timeout=30, chunk_size=65536, rate_limiter=None, validate=None):
+    """
+    Stream a URL to filepath via a temporary file that is only moved into place once complete.
+    If the file exists and the cache holds its validators, a conditional request is sent first.
+    If given, validate(path) is called on the complete temporary file; when it returns False the
+    download is discarded, so an existing file and its cache entry are left untouched.
+
+    Returns:
+        bool: True if new content was written, False if the server reported it as not modified
+    Raises:
+        InvalidContentError if validate rejects the content,
+        requests.RequestException / OSError on other failures (any partial download is removed)
+    """
+    filename = os.path.basename(filepath)
+    headers = HEADERS
+    cached = cache.get(filename) if cache is not None and os.path.exists(filepath) else None
+    if cached:
+        headers = dict(HEADERS)
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+
+    tmp_path = filepath + '.part'
+    with SESSION.get(url, timeout=timeout, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+
+        # Let urllib3 undo any Content-Encoding while copying straight from the socket
+        response.raw.decode_content = True
+        try:
+            with open(tmp_path, 'wb', buffering=chunk_size) as f:
+                shutil.copyfileobj(response.raw, f, length=chunk_size)
+                size = f.tell()
+
+            # Content-Length is only comparable to the written size for unencoded bodies
+            expected = response.headers.get('Content-Length')
+            encoding = response.headers.get('Content-Encoding', 'identity')
+            if expected is not None and encoding == 'identity' and int(expected) != size:
+                raise IOError(f"Incomplete download: expected {expected} bytes, got {size}")
+            if validate is not None and not validate(tmp_path):
+                raise InvalidContentError(f"Downloaded content from {url} failed validation")
+
+            os.replace(tmp_path, filepath)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    if cache is not None:
+        cache.update(filename, response, size)
+    return True
@@ -0,0 +1,38 @@
+import json
+import os
+import threading
+
+class JsonFileCache:
+    """
+    Thread-safe key -> value map persisted as one JSON file.
+    A missing or unreadable file starts an empty cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+
+    def get(self, key):
+        """Return the cached value for a key, or None."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def set(self, key, value):
+        """Store a value for a key."""
+        with self._lock:
+            self._entries[key] = value
+
+    def save(self):
+        """Write the cache to disk atomically."""
+        with self._lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
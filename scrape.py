@@ -1,15 +1,63 @@
-import requests
+import os
 import pandas as pd
 import json
 from tqdm import tqdm
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http_utils import create_session
+
+def fetch_page(session, base_url, page):
+    """Fetch the results of a single API page. Returns None if the request fails after the session's retries."""
+    page_url = f"{base_url}?page={page}"
+    
+    try:
+        response = session.get(page_url, timeout=30)
+        if response.ok:
+            return response.json()['results']
+        print(f"Page {page} request failed with status {response.status_code}")
+    except Exception as e:
+        print(f"Error fetching page {page}: {str(e)}")
+    return None
+
+def read_checkpoint_meta(checkpoint_file):
+    """Return the API meta ({'found': ..., 'limit': ...}) a page checkpoint was written for, or None."""
+    if not checkpoint_file or not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        try:
+            return json.loads(f.readline())['meta']
+        except (ValueError, KeyError, TypeError):
+            return None
+
+def read_checkpoint(checkpoint_file):
+    """Yield (page, results) for every complete line of a page checkpoint file (a torn last line is skipped)."""
+    if not checkpoint_file or not os.path.exists(checkpoint_file):
+        return
+    with open(checkpoint_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                yield record['page'], record['results']
+            except (ValueError, KeyError, TypeError):
+                continue
 
 def fetch_openaerial_data(base_url="https://api.openaerialmap.org/meta", max_pages=None, retry_count=3, 
-                          delay_between_requests=0.5):
-    """Fetch all data from OpenAerialMap API with pagination"""
+                          max_workers=16, checkpoint_file="oam_pages.jsonl"):
+    """
+    Fetch all data from OpenAerialMap API with pagination, fetching up to max_workers pages concurrently.
+    Each fetched page is appended to checkpoint_file (JSONL) as it arrives, so an interrupted run resumes
+    with only the missing pages. The checkpoint records the API's record count and page size and is
+    discarded when they change, since pages are offsets and would no longer line up.
+    Pass checkpoint_file=None to keep pages in memory only.
+    
+    Returns:
+        tuple: (list of records in page order, sorted list of pages that could not be fetched)
+    """
+    
+    # One session for all pages: keep-alive connections (one per worker) and urllib3 retries with backoff
+    session = create_session(pool_size=max_workers, retries=retry_count)
     
     # Get first page to determine total pages
-    response = requests.get(base_url)
+    response = session.get(base_url, timeout=30)
     if not response.ok:
         raise Exception(f"Failed to fetch initial data: {response.status_code}")
     
@@ -25,76 +73,140 @@ def fetch_openaerial_data(base_url="https://api.openaerialmap.org/meta", max_pag
         total_pages = min(total_pages, max_pages)
         print(f"Limiting to {max_pages} pages")
     
-    # Initialize with first page results
-    all_results = data['results']
+    meta = {'found': total_records, 'limit': limit_per_page}
+    if checkpoint_file and os.path.exists(checkpoint_file) and read_checkpoint_meta(checkpoint_file) != meta:
+        print(f"Discarding {checkpoint_file}: it was written for a different result set")
+        os.remove(checkpoint_file)
     
-    # Fetch remaining pages
-    for page in tqdm(range(2, total_pages + 1), desc="Fetching pages"):
-        page_url = f"{base_url}?page={page}"
-        
-        # Add retry mechanism for robust fetching
-        for attempt in range(retry_count):
-            try:
-                response = requests.get(page_url)
-                if response.ok:
-                    page_data = response.json()
-                    all_results.extend(page_data['results'])
-                    break
-                else:
-                    print(f"Page {page} request failed with status {response.status_code}")
-                    if attempt < retry_count - 1:
-                        time.sleep(1)  # Wait longer between retries
-            except Exception as e:
-                print(f"Error fetching page {page}, attempt {attempt+1}: {str(e)}")
-                if attempt < retry_count - 1:
-                    time.sleep(1)
+    done_pages = {page for page, _ in read_checkpoint(checkpoint_file)}
+    if done_pages:
+        print(f"Resuming: {len(done_pages)} pages already in {checkpoint_file}")
+    
+    page_results = {}
+    checkpoint = open(checkpoint_file, 'a') if checkpoint_file else None
+    if checkpoint is not None and checkpoint.tell() == 0:
+        checkpoint.write(json.dumps({'meta': meta}) + '\n')
+    elif checkpoint is not None:
+        # Terminate a line torn by an interrupted run so new pages start on their own line
+        with open(checkpoint_file, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                checkpoint.write('\n')
+    
+    def store(page, results):
+        # Checkpointed pages go straight to disk instead of accumulating in memory
+        if checkpoint is None:
+            page_results[page] = results
+        else:
+            checkpoint.write(json.dumps({'page': page, 'results': results}) + '\n')
+            checkpoint.flush()
+    
+    try:
+        if 1 not in done_pages:
+            store(1, data['results'])
+        del data
         
-        # Small delay to avoid overloading the API
-        time.sleep(delay_between_requests)
+        # Fetch remaining pages concurrently; the bounded pool also limits the load on the API
+        pending_pages = [page for page in range(2, total_pages + 1) if page not in done_pages]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(fetch_page, session, base_url, page): page
+                       for page in pending_pages}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Fetching pages"):
+                results = future.result()
+                if results is not None:
+                    store(futures[future], results)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+    
+    if checkpoint_file:
+        page_results = {page: results for page, results in read_checkpoint(checkpoint_file) if page <= total_pages}
+    
+    missing_pages = sorted(set(range(1, total_pages + 1)) - set(page_results))
+    if missing_pages:
+        print(f"Warning: {len(missing_pages)} pages could not be fetched: {missing_pages}")
+    
+    # Keep records in page order
+    all_results = []
+    for page in sorted(page_results):
+        all_results.extend(page_results[page])
         
     print(f"Successfully fetched {len(all_results)} records")
-    return all_results
+    return all_results, missing_pages
 
 def process_data(results):
-    """Process and flatten nested data structures"""
-    processed_data = []
+    """
+    Process and flatten nested data structures into a DataFrame using vectorized column operations.
+    The nested geojson/properties are popped from the records (the raw results are consumed), so they are
+    released as soon as they are flattened instead of living on in the DataFrame.
+    """
+    has_properties = any('properties' in item for item in results)
+    properties = [item.pop('properties', None) for item in results]
+    for item in results:
+        item.pop('geojson', None)
+    df = pd.DataFrame(results)
     
-    for item in tqdm(results, desc="Processing records"):
-        flat_item = item.copy()
-        
-        # Extract information from footprint
-        if 'footprint' in flat_item and flat_item['footprint']:
-            flat_item['footprint_coords'] = flat_item['footprint'].replace("POLYGON((", "").replace("))", "")
-        
-        # Extract bbox as separate columns
-        if 'bbox' in flat_item and flat_item['bbox'] and len(flat_item['bbox']) == 4:
-            flat_item['bbox_min_lon'] = flat_item['bbox'][0]
-            flat_item['bbox_min_lat'] = flat_item['bbox'][1]
-            flat_item['bbox_max_lon'] = flat_item['bbox'][2]
-            flat_item['bbox_max_lat'] = flat_item['bbox'][3]
-        
-        # Flatten properties
-        if 'properties' in flat_item and flat_item['properties']:
-            for key, value in flat_item['properties'].items():
-                flat_item[f'property_{key}'] = value
-        
-        # Remove nested structures to avoid duplication
-        for key in ['geojson', 'properties']:
-            if key in flat_item:
-                del flat_item[key]
-        
-        processed_data.append(flat_item)
+    # Extract information from footprint
+    if 'footprint' in df.columns:
+        footprint = df['footprint']
+        has_footprint = footprint.notna() & footprint.ne('')
+        df['footprint_coords'] = (
+            footprint.where(has_footprint)
+            .str.replace("POLYGON((", "", regex=False)
+            .str.replace("))", "", regex=False)
+        )
+    
+    # New column blocks are collected and added in a single concat (one copy of the frame)
+    new_columns = []
     
-    return processed_data
+    # Extract bbox as separate columns
+    if 'bbox' in df.columns:
+        bbox_cols = ['bbox_min_lon', 'bbox_min_lat', 'bbox_max_lon', 'bbox_max_lat']
+        valid_bbox = df['bbox'].map(lambda b: isinstance(b, (list, tuple)) and len(b) == 4)
+        bbox_df = pd.DataFrame(df.loc[valid_bbox, 'bbox'].tolist(), columns=bbox_cols, index=df.index[valid_bbox])
+        new_columns.append(bbox_df.reindex(df.index))
+    
+    # Flatten properties, then drop the nested dicts
+    if has_properties:
+        properties = [p if isinstance(p, dict) else {} for p in properties]
+        properties_df = pd.json_normalize(properties, max_level=0).add_prefix('property_')
+        properties_df.index = df.index
+        new_columns.append(properties_df)
+    del properties
+    
+    return pd.concat([df] + new_columns, axis=1) if new_columns else df
+
+def _to_parquet_value(value):
+    """Serialize a nested or mixed-type cell so pyarrow can store the column as strings."""
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value)
+    if value is None or value != value:
+        return None
+    return str(value)
+
+def save_parquet(df, path):
+    """Save the DataFrame as zstd-compressed Parquet, keeping dtypes for the downstream steps."""
+    df = df.copy()
+    # Parse the timestamp the filter compares on once, here, instead of on every load.
+    # ISO8601 accepts every ISO shape per row (fractional seconds, Z or offsets); if any value still
+    # fails to parse, the raw strings are kept so this raw copy loses nothing.
+    if 'uploaded_at' in df.columns:
+        uploaded_at = pd.to_datetime(df['uploaded_at'], errors='coerce', utc=True, format='ISO8601')
+        if not (uploaded_at.isna() & df['uploaded_at'].notna()).any():
+            df['uploaded_at'] = uploaded_at
+    # Parquet columns need a single type; nested (e.g. bbox lists) or mixed object columns are stored as JSON/strings
+    for col in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[col], skipna=True) not in ('string', 'empty', 'boolean', 'integer', 'floating'):
+            df[col] = df[col].map(_to_parquet_value)
+    df.to_parquet(path, index=False, compression='zstd')
 
 def main():
     # Set max_pages to None to fetch all pages
-    results = fetch_openaerial_data(max_pages=None)  # This will fetch ALL pages
-    
-    processed_data = process_data(results)
+    results, missing_pages = fetch_openaerial_data(max_pages=None)  # This will fetch ALL pages
     
-    # Convert to pandas DataFrame
-    df = pd.DataFrame(processed_data)
+    # Convert to a flat pandas DataFrame (this consumes the nested properties), then drop the remaining records
+    df = process_data(results)
+    del results
     
     # Print dataset info
     print("\nDataset Summary:")
@@ -104,9 +216,15 @@ def main():
     if 'platform' in df.columns:
         print(df['platform'].value_counts())
     
-    # Save to CSV
-    df.to_csv("openaerial_data.csv", index=False)
-    print(f"\nSaved dataset to openaerial_data.csv")
+    # Save to Parquet
+    save_parquet(df, "openaerial_data.parquet")
+    print(f"\nSaved dataset to openaerial_data.parquet")
+    
+    # Keep the checkpoint while pages are missing so a rerun fetches only those; otherwise start fresh next time
+    if missing_pages:
+        print(f"{len(missing_pages)} pages are missing; rerun scrape.py to fetch them from the oam_pages.jsonl checkpoint")
+    elif os.path.exists("oam_pages.jsonl"):
+        os.remove("oam_pages.jsonl")
 
 if __name__ == "__main__":
     main()